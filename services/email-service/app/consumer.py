@@ -1,24 +1,28 @@
-import pika
-import json
+import aio_pika
+import msgspec
 import logging
 import asyncio
 import httpx
 import os
 import sys
+from functools import partial
 from datetime import datetime
-from sqlalchemy import create_engine, Column, String, DateTime, Text
+from sqlalchemy import create_engine, Column, Integer, String, DateTime, Text
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
-from sqlalchemy.dialects.postgresql import UUID
+from sqlalchemy.sql import func
+from sqlalchemy import update, text, Index
+from sqlalchemy.dialects.postgresql import UUID, insert
 import uuid
+from typing import Union
 
 from smtp_handler import SMTPHandler
 
-from shared.utils import RedisCache
+from shared.utils import AsyncRedisCache
 
 # Initialize Redis
 REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379")
-cache = RedisCache(REDIS_URL)
+cache = AsyncRedisCache(REDIS_URL)
 
 
 logging.basicConfig(level=logging.INFO)
@@ -26,7 +30,16 @@ logger = logging.getLogger(__name__)
 
 # Database setup
 DATABASE_URL = os.getenv("DATABASE_URL")
-engine = create_engine(DATABASE_URL)
+engine = create_engine(
+    DATABASE_URL,
+    executemany_mode="values_plus_batch",
+    insertmanyvalues_page_size=500,
+    executemany_batch_page_size=500,
+    pool_size=20,
+    max_overflow=20,
+    pool_recycle=1800,
+    pool_pre_ping=True
+)
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 Base = declarative_base()
 
@@ -41,71 +54,139 @@ class NotificationLog(Base):
     body = Column(Text)
     status = Column(String, default="pending")
     error_message = Column(Text)
-    retry_count = Column(String, default="0")
+    retry_count = Column(Integer, default=0, nullable=False)
     created_at = Column(DateTime, default=datetime.utcnow)
-    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=func.timezone('utc', func.now()))
+
+    __table_args__ = (
+        Index('ix_notif_pending', 'status', postgresql_where=text("status = 'pending'")),
+    )
 
 Base.metadata.create_all(bind=engine)
 
+def migrate_retry_count():
+    """Convert retry_count from its old varchar type on existing tables"""
+    with engine.begin() as conn:
+        data_type = conn.execute(text(
+            "SELECT data_type FROM information_schema.columns "
+            "WHERE table_name = 'email_notifications' AND column_name = 'retry_count'"
+        )).scalar()
+        if data_type == "integer":
+            return
+        conn.execute(text(
+            "ALTER TABLE email_notifications "
+            "ALTER COLUMN retry_count TYPE integer USING COALESCE(retry_count, '0')::integer"
+        ))
+        conn.execute(text(
+            "ALTER TABLE email_notifications "
+            "ALTER COLUMN retry_count SET DEFAULT 0, "
+            "ALTER COLUMN retry_count SET NOT NULL"
+        ))
+
+def migrate_pending_index():
+    """Add the pending-status partial index to tables created before it was declared"""
+    with engine.begin() as conn:
+        conn.execute(text(
+            "CREATE INDEX IF NOT EXISTS ix_notif_pending "
+            "ON email_notifications (status) WHERE status = 'pending'"
+        ))
+
+migrate_retry_count()
+migrate_pending_index()
+
 # Configuration
 RABBITMQ_URL = os.getenv("RABBITMQ_URL")
 TEMPLATE_SERVICE_URL = os.getenv("TEMPLATE_SERVICE_URL")
 USER_SERVICE_URL = os.getenv("USER_SERVICE_URL", "http://user-service:8001")
 MAX_RETRIES = 3
+# Exponential backoff tiers (milliseconds), one TTL retry queue per tier
+RETRY_DELAYS = [(2 ** n) * 1000 for n in range(MAX_RETRIES)]
+PREFETCH_COUNT = int(os.getenv("RABBITMQ_PREFETCH", "10"))
+CONCURRENCY = int(os.getenv("EMAIL_CONCURRENCY", str(PREFETCH_COUNT)))
+
+class EmailMessage(msgspec.Struct):
+    """Payload published to email.queue"""
+    notification_id: str
+    user_id: Union[int, str]  # user-service ids are integers; some producers send them as strings
+    template_code: str
+    variables: dict
+    retry_count: int = 0
+
+# Validate once at the boundary; strict=False still accepts retry_count sent as a string
+email_message_decoder = msgspec.json.Decoder(EmailMessage, strict=False)
 
 smtp_handler = SMTPHandler()
 
+# Bound how many deliveries are in flight at once
+semaphore = asyncio.Semaphore(CONCURRENCY)
+
+# Shared HTTP client (keep-alive connections reused across messages)
+HTTP = httpx.AsyncClient(
+    timeout=10.0,
+    limits=httpx.Limits(max_keepalive_connections=50, max_connections=100)
+)
+
 async def fetch_user_email(user_id: str) -> str:
     """Fetch user email from user service"""
-    async with httpx.AsyncClient() as client:
-        response = await client.get(f"{USER_SERVICE_URL}/api/v1/users/{user_id}")
-        if response.status_code == 200:
-            data = response.json()
-            return data["data"]["email"]
+    # user-service caches users in the shared Redis; skip the HTTP hop on a hit
+    cached_user = await cache.get(f"user:{user_id}")
+    if cached_user:
+        return cached_user["email"]
+    
+    response = await HTTP.get(f"{USER_SERVICE_URL}/api/v1/users/{user_id}")
+    if response.status_code == 200:
+        data = response.json()
+        return data["data"]["email"]
     raise Exception("User not found")
 
 async def render_template(template_code: str, variables: dict):
     """Render template with variables"""
-    async with httpx.AsyncClient() as client:
-        response = await client.post(
-            f"{TEMPLATE_SERVICE_URL}/api/v1/templates/{template_code}/render",
-            json=variables
-        )
-        if response.status_code == 200:
-            return response.json()["data"]
+    response = await HTTP.post(
+        f"{TEMPLATE_SERVICE_URL}/api/v1/templates/{template_code}/render",
+        json=variables
+    )
+    if response.status_code == 200:
+        return response.json()["data"]
     raise Exception("Template rendering failed")
 
-async def process_email(message_data: dict, retry_count: int = 0):
+def upsert_notification_log(db, values: dict, update_fields: tuple):
+    """Insert a log row, or update `update_fields` if it already exists"""
+    stmt = insert(NotificationLog.__table__).values(**values)
+    set_ = {field: stmt.excluded[field] for field in update_fields}
+    set_["updated_at"] = func.timezone('utc', func.now())
+    db.execute(stmt.on_conflict_do_update(index_elements=["notification_id"], set_=set_))
+
+async def process_email(email: EmailMessage):
     """Process email notification"""
-    notification_id = message_data["notification_id"]
-    user_id = message_data["user_id"]
+    notification_id = email.notification_id
+    user_id = str(email.user_id)
+    retry_count = email.retry_count
+    status_key = f"notification_status:{notification_id}"
     
     db = SessionLocal()
     
     try:
-        # Check if already processed
-        existing = db.query(NotificationLog).filter(
-            NotificationLog.notification_id == notification_id
-        ).first()
+        # Set status: processing, and check if already processed (status is
+        # cached for 24h on delivery) in the same round-trip. A delivered
+        # status is left untouched so concurrent duplicates still see it.
+        cached_status = await cache.set_unless_status(
+            status_key,
+            {"status": "processing", "updated_at": datetime.utcnow().isoformat()},
+            86400,
+            "delivered"
+        )
         
-        if existing and existing.status == "delivered":
+        if cached_status and cached_status.get("status") == "delivered":
             logger.info(f"Email {notification_id} already delivered")
             return True
-        
-        # Set status: processing
-        cache.set(
-            f"notification_status:{notification_id}",
-            {"status": "processing", "updated_at": datetime.utcnow().isoformat()},
-            ttl=86400
-        )
 
         # Fetch user email
         user_email = await fetch_user_email(user_id)
         
         # Render template
         rendered = await render_template(
-            message_data["template_code"],
-            message_data["variables"]
+            email.template_code,
+            email.variables
         )
         
         subject = rendered.get("subject", "Notification")
@@ -115,24 +196,22 @@ async def process_email(message_data: dict, retry_count: int = 0):
         await smtp_handler.send_email(user_email, subject, body)
         
         # Log success
-        if existing:
-            existing.status = "delivered"
-            existing.updated_at = datetime.utcnow()
-        else:
-            log = NotificationLog(
-                notification_id=notification_id,
-                user_id=user_id,
-                email=user_email,
-                subject=subject,
-                body=body,
-                status="delivered"
-            )
-            db.add(log)
-        
+        upsert_notification_log(
+            db,
+            {
+                "notification_id": notification_id,
+                "user_id": user_id,
+                "email": user_email,
+                "subject": subject,
+                "body": body,
+                "status": "delivered"
+            },
+            update_fields=("status",)
+        )
         db.commit()
 
-        cache.set(
-            f"notification_status:{notification_id}",
+        await cache.set(
+            status_key,
             {"status": "delivered", "delivered_at": datetime.utcnow().isoformat()},
             ttl=86400
         )
@@ -144,104 +223,134 @@ async def process_email(message_data: dict, retry_count: int = 0):
         logger.error(f"Email processing failed: {e}")
 
         # Update cache for failure
-        cache.set(
-            f"notification_status:{notification_id}",
+        await cache.set(
+            status_key,
             {"status": "failed", "error": str(e), "failed_at": datetime.utcnow().isoformat()},
             ttl=86400
         )
         
         # Log failure
+        db.rollback()
         if retry_count < MAX_RETRIES:
             # Will be retried
-            if existing:
-                existing.retry_count = str(retry_count + 1)
-                existing.error_message = str(e)
-                db.commit()
+            db.execute(
+                update(NotificationLog)
+                .where(NotificationLog.notification_id == notification_id)
+                .values(retry_count=NotificationLog.retry_count + 1, error_message=str(e))
+            )
+            db.commit()
             return False
         else:
             # Permanent failure
-            if existing:
-                existing.status = "failed"
-                existing.error_message = str(e)
-            else:
-                log = NotificationLog(
-                    notification_id=notification_id,
-                    user_id=user_id,
-                    email="unknown",
-                    status="failed",
-                    error_message=str(e),
-                    retry_count=str(retry_count)
-                )
-                db.add(log)
+            upsert_notification_log(
+                db,
+                {
+                    "notification_id": notification_id,
+                    "user_id": user_id,
+                    "email": "unknown",
+                    "status": "failed",
+                    "error_message": str(e),
+                    "retry_count": retry_count
+                },
+                update_fields=("status", "error_message")
+            )
             db.commit()
             raise e
     finally:
         db.close()
 
-def callback(ch, method, properties, body):
+def retry_queue_name(delay: int) -> str:
+    """Name of the TTL queue that holds retries for `delay` milliseconds"""
+    return f"email.retry.{delay}ms"
+
+async def declare_retry_queues(channel):
+    """Declare TTL queues that dead-letter expired retries back to the email route"""
+    for delay in RETRY_DELAYS:
+        await channel.declare_queue(
+            retry_queue_name(delay),
+            durable=True,
+            arguments={
+                'x-message-ttl': delay,
+                'x-dead-letter-exchange': 'notifications.direct',
+                'x-dead-letter-routing-key': 'email'
+            }
+        )
+
+async def on_message(exchange, retry_exchange, message):
     """RabbitMQ message callback"""
+    async with message.process(requeue=False):
+        try:
+            email = email_message_decoder.decode(message.body)
+            logger.info(f"Processing email notification: {email.notification_id}")
+            
+            # Process with retry logic
+            retry_count = email.retry_count
+            
+            async with semaphore:
+                success = await process_email(email)
+            
+            if not success:
+                # Retry with exponential backoff
+                if retry_count < MAX_RETRIES:
+                    # Park in the retry queue for this tier; the broker
+                    # dead-letters it back to the email route once the TTL expires
+                    delay = RETRY_DELAYS[retry_count]
+                    
+                    await retry_exchange.publish(
+                        aio_pika.Message(
+                            body=msgspec.json.encode(
+                                msgspec.structs.replace(email, retry_count=retry_count + 1)
+                            ),
+                            delivery_mode=aio_pika.DeliveryMode.PERSISTENT
+                        ),
+                        routing_key=retry_queue_name(delay)
+                    )
+                    logger.info(f"Email {email.notification_id} requeued for retry {retry_count + 1}")
+                else:
+                    # Move to dead letter queue
+                    await exchange.publish(
+                        aio_pika.Message(body=message.body),
+                        routing_key='failed'
+                    )
+                    logger.error(f"Email {email.notification_id} moved to DLQ after {MAX_RETRIES} retries")
+                    
+        except Exception as e:
+            logger.error(f"Callback error: {e}")
+            raise
+
+async def consume():
+    """Consume the email queue on a single event loop"""
+    # Separate connections so publisher flow control can't stall consuming/acks
+    connection = await aio_pika.connect_robust(RABBITMQ_URL)
+    publish_connection = await aio_pika.connect_robust(RABBITMQ_URL)
+    
     try:
-        message_data = json.loads(body)
-        logger.info(f"Processing email notification: {message_data['notification_id']}")
+        channel = await connection.channel()
+        publish_channel = await publish_connection.channel()
         
-        # Process with retry logic
-        retry_count = int(message_data.get("retry_count", 0))
+        # Allow several unacked messages so SMTP/HTTP latency overlaps
+        await channel.set_qos(prefetch_count=PREFETCH_COUNT)
         
-        success = asyncio.run(process_email(message_data, retry_count))
+        exchange = await publish_channel.get_exchange('notifications.direct')
+        queue = await channel.get_queue('email.queue')
+        await declare_retry_queues(publish_channel)
         
-        if success:
-            ch.basic_ack(delivery_tag=method.delivery_tag)
-        else:
-            # Retry with exponential backoff
-            if retry_count < MAX_RETRIES:
-                message_data["retry_count"] = retry_count + 1
-                
-                # Re-queue with delay (exponential backoff)
-                delay = (2 ** retry_count) * 1000  # milliseconds
-                
-                ch.basic_publish(
-                    exchange='notifications.direct',
-                    routing_key='email',
-                    body=json.dumps(message_data),
-                    properties=pika.BasicProperties(
-                        delivery_mode=2,
-                        headers={'x-delay': delay}
-                    )
-                )
-                ch.basic_ack(delivery_tag=method.delivery_tag)
-                logger.info(f"Email {message_data['notification_id']} requeued for retry {retry_count + 1}")
-            else:
-                # Move to dead letter queue
-                ch.basic_publish(
-                    exchange='notifications.direct',
-                    routing_key='failed',
-                    body=body
-                )
-                ch.basic_ack(delivery_tag=method.delivery_tag)
-                logger.error(f"Email {message_data['notification_id']} moved to DLQ after {MAX_RETRIES} retries")
-                
-    except Exception as e:
-        logger.error(f"Callback error: {e}")
-        ch.basic_nack(delivery_tag=method.delivery_tag, requeue=False)
+        # Start consuming
+        await queue.consume(partial(on_message, exchange, publish_channel.default_exchange))
+        
+        logger.info("Email consumer started. Waiting for messages...")
+        await asyncio.Future()
+    finally:
+        await connection.close()
+        await publish_connection.close()
+        await HTTP.aclose()
+        await smtp_handler.close()
+        await cache.close()
 
 def main():
     """Start email consumer"""
     logger.info("Starting email service consumer...")
-    
-    connection = pika.BlockingConnection(pika.URLParameters(RABBITMQ_URL))
-    channel = connection.channel()
-    
-    # Set QoS to process one message at a time
-    channel.basic_qos(prefetch_count=1)
-    
-    # Start consuming
-    channel.basic_consume(
-        queue='email.queue',
-        on_message_callback=callback
-    )
-    
-    logger.info("Email consumer started. Waiting for messages...")
-    channel.start_consuming()
+    asyncio.run(consume())
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
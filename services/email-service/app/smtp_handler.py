@@ -1,4 +1,5 @@
 import aiosmtplib
+import asyncio
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 import logging
@@ -6,13 +7,88 @@ import os
 
 logger = logging.getLogger(__name__)
 
+KEEPALIVE_INTERVAL = 60  # seconds
+
 class SMTPHandler:
     def __init__(self):
         self.smtp_host = os.getenv("SMTP_HOST", "smtp.gmail.com")
         self.smtp_port = int(os.getenv("SMTP_PORT", "587"))
         self.smtp_user = os.getenv("SMTP_USER")
         self.smtp_password = os.getenv("SMTP_PASSWORD")
-    
+        self.pool_size = int(os.getenv("SMTP_POOL_SIZE", "10"))
+        # One persistent session per slot so deliveries run over separate streams
+        self._clients = [None] * self.pool_size
+        self._locks = [asyncio.Lock() for _ in range(self.pool_size)]
+        self._next_slot = 0
+        self._keepalive_task = None
+
+    def _pick_slot(self) -> int:
+        """Round-robin over the pooled sessions"""
+        slot = self._next_slot
+        self._next_slot = (slot + 1) % self.pool_size
+        return slot
+
+    def _discard(self, slot: int):
+        """Drop a slot's session, closing its socket if one is still open"""
+        client = self._clients[slot]
+        self._clients[slot] = None
+        if client is not None:
+            client.close()
+
+    async def _ensure(self, slot: int) -> aiosmtplib.SMTP:
+        """Connect and authenticate a slot once, reconnecting if the session dropped"""
+        async with self._locks[slot]:
+            client = self._clients[slot]
+            if client is None or not client.is_connected:
+                self._discard(slot)
+                client = aiosmtplib.SMTP(
+                    hostname=self.smtp_host,
+                    port=self.smtp_port,
+                    start_tls=True
+                )
+                try:
+                    await client.connect()
+                    if self.smtp_user:
+                        await client.login(self.smtp_user, self.smtp_password)
+                except Exception:
+                    # Don't leak the socket when login fails after connecting
+                    client.close()
+                    raise
+                self._clients[slot] = client
+                logger.info(f"Connected to SMTP server {self.smtp_host}:{self.smtp_port} (slot {slot})")
+
+            if self._keepalive_task is None:
+                self._keepalive_task = asyncio.create_task(self._keepalive())
+            return client
+
+    async def _keepalive(self):
+        """Send NOOP periodically so the server doesn't drop idle sessions"""
+        while True:
+            await asyncio.sleep(KEEPALIVE_INTERVAL)
+            for slot in range(self.pool_size):
+                async with self._locks[slot]:
+                    client = self._clients[slot]
+                    if client is None or not client.is_connected:
+                        continue
+                    try:
+                        await client.noop()
+                    except aiosmtplib.SMTPException as e:
+                        logger.warning(f"SMTP keepalive failed (slot {slot}): {e}")
+                        self._discard(slot)
+
+    async def close(self):
+        """Close all persistent SMTP sessions"""
+        if self._keepalive_task is not None:
+            self._keepalive_task.cancel()
+            self._keepalive_task = None
+        for slot, client in enumerate(self._clients):
+            if client is not None and client.is_connected:
+                try:
+                    await client.quit()
+                except aiosmtplib.SMTPException:
+                    client.close()
+            self._clients[slot] = None
+
     async def send_email(self, to_email: str, subject: str, body: str, html: bool = True):
         """Send email via SMTP"""
         if to_email == "fake@example.com":
@@ -22,23 +98,26 @@ class SMTPHandler:
             message["From"] = self.smtp_user
             message["To"] = to_email
             message["Subject"] = subject
-            
+
             if html:
                 message.attach(MIMEText(body, "html"))
             else:
                 message.attach(MIMEText(body, "plain"))
-            
-            await aiosmtplib.send(
-                message,
-                hostname=self.smtp_host,
-                port=self.smtp_port,
-                username=self.smtp_user,
-                password=self.smtp_password,
-                start_tls=True
-            )
-            
+
+            slot = self._pick_slot()
+            client = await self._ensure(slot)
+            try:
+                await client.send_message(message)
+            except aiosmtplib.SMTPServerDisconnected:
+                # Session went stale between sends; reconnect and retry once
+                async with self._locks[slot]:
+                    if self._clients[slot] is client:
+                        self._discard(slot)
+                client = await self._ensure(slot)
+                await client.send_message(message)
+
             logger.info(f"Email sent successfully to {to_email}")
             return True
         except Exception as e:
             logger.error(f"Failed to send email to {to_email}: {e}")
-            raise e
\ No newline at end of file
+            raise e
@@ -1,5 +1,6 @@
 import redis
-import json
+import redis.asyncio
+import orjson
 from typing import Optional, Any
 from functools import wraps
 import time
@@ -9,19 +10,19 @@ logger = logging.getLogger(__name__)
 
 class RedisCache:
     def __init__(self, redis_url: str):
-        self.redis_client = redis.from_url(redis_url, decode_responses=True)
+        self.redis_client = redis.from_url(redis_url)
     
     def get(self, key: str) -> Optional[Any]:
         try:
             value = self.redis_client.get(key)
-            return json.loads(value) if value else None
+            return orjson.loads(value) if value else None
         except Exception as e:
             logger.error(f"Redis get error: {e}")
             return None
     
     def set(self, key: str, value: Any, ttl: int = 300):
         try:
-            self.redis_client.setex(key, ttl, json.dumps(value))
+            self.redis_client.setex(key, ttl, orjson.dumps(value))
         except Exception as e:
             logger.error(f"Redis set error: {e}")
     
@@ -39,3 +40,70 @@ class RedisCache:
             logger.error(f"Redis ping error: {e}")
             return False
 
+
+# Read a JSON value and overwrite it in the same step, unless its "status"
+# is one of ARGV[3..]; a protected value is never touched
+_SET_UNLESS_STATUS = """
+local v = redis.call('GET', KEYS[1])
+if v then
+  local status = cjson.decode(v)['status']
+  for i = 3, #ARGV do
+    if status == ARGV[i] then return v end
+  end
+end
+redis.call('SET', KEYS[1], ARGV[1], 'EX', ARGV[2])
+return v
+"""
+
+
+class AsyncRedisCache:
+    """Non-blocking counterpart of RedisCache for use inside event loops."""
+
+    def __init__(self, redis_url: str, max_connections: int = 50):
+        pool = redis.asyncio.ConnectionPool.from_url(
+            redis_url, max_connections=max_connections
+        )
+        self.redis_client = redis.asyncio.Redis(connection_pool=pool)
+        self._set_unless_status = self.redis_client.register_script(_SET_UNLESS_STATUS)
+
+    async def get(self, key: str) -> Optional[Any]:
+        try:
+            value = await self.redis_client.get(key)
+            return orjson.loads(value) if value else None
+        except Exception as e:
+            logger.error(f"Redis get error: {e}")
+            return None
+
+    async def set(self, key: str, value: Any, ttl: int = 300):
+        try:
+            await self.redis_client.setex(key, ttl, orjson.dumps(value))
+        except Exception as e:
+            logger.error(f"Redis set error: {e}")
+
+    async def set_unless_status(self, key: str, value: Any, ttl: int, *statuses: str) -> Optional[Any]:
+        """Set a key unless its current status is one of `statuses`; return the previous value"""
+        try:
+            previous = await self._set_unless_status(
+                keys=[key], args=[orjson.dumps(value), ttl, *statuses]
+            )
+            return orjson.loads(previous) if previous else None
+        except Exception as e:
+            logger.error(f"Redis set_unless_status error: {e}")
+            return None
+
+    async def delete(self, key: str):
+        try:
+            await self.redis_client.delete(key)
+        except Exception as e:
+            logger.error(f"Redis delete error: {e}")
+
+    async def ping(self) -> bool:
+        """Check Redis connection health."""
+        try:
+            return await self.redis_client.ping()
+        except Exception as e:
+            logger.error(f"Redis ping error: {e}")
+            return False
+
+    async def close(self):
+        await self.redis_client.aclose()
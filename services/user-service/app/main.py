@@ -1,28 +1,52 @@
-from fastapi import FastAPI, Depends, HTTPException, status, Path
+from fastapi import FastAPI, Depends, HTTPException, status, Path, Request
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse, Response
+from fastapi.concurrency import run_in_threadpool
+from fastapi.exceptions import RequestValidationError
 from sqlalchemy.orm import Session
-from sqlalchemy import text
+from sqlalchemy import text, select, or_
+from pydantic import ValidationError
 from typing import List
 from app.database import get_db, init_db
 from app.models import User, NotificationPreference
 from app.schemas import (
     UserCreate, UserUpdate, UserResponse,
     NotificationPreferenceCreate, NotificationPreferenceUpdate, NotificationPreferenceResponse,
-    LoginRequest, Token, HealthResponse
+    LoginRequest, Token, HealthResponse,
+    UserListAdapter, PreferenceListAdapter
 )
+from app.schemas_fast import login_request_decoder, json_encoder, TokenFast, HealthResponseFast
 from app.auth import create_access_token, get_current_active_user
 from app.config import settings
 from app.redis_client import (
-    cache_user_preferences, get_cached_preferences,
-    invalidate_preferences_cache, get_redis
+    cache_user_preferences_raw, get_cached_preferences, get_or_lock_preferences_raw,
+    invalidate_preferences_cache, get_redis,
+    cache_user, get_cached_user_raw, invalidate_user_cache
 )
 from datetime import timedelta
+import json
+import msgspec
 import redis
 
+# Columns needed to build a UserResponse, for Core queries that skip the ORM
+USER_RESPONSE_COLUMNS = (
+    User.id, User.username, User.email, User.push_token,
+    User.is_active, User.created_at, User.updated_at
+)
+
+# Columns needed to build a NotificationPreferenceResponse
+PREFERENCE_RESPONSE_COLUMNS = (
+    NotificationPreference.id, NotificationPreference.user_id,
+    NotificationPreference.notification_type, NotificationPreference.channel,
+    NotificationPreference.enabled, NotificationPreference.created_at,
+    NotificationPreference.updated_at
+)
+
 app = FastAPI(
     title="User Service",
     description="User management and notification preferences service",
-    version="1.0.0"
+    version="1.0.0",
+    default_response_class=ORJSONResponse
 )
 
 # CORS middleware
@@ -65,22 +89,96 @@ async def health_check():
     # Check Redis connection
     try:
         redis_client = get_redis()
-        redis_client.ping()
+        await redis_client.ping()
         health_status["redis"] = "connected"
     except Exception as e:
         health_status["redis"] = f"error: {str(e)}"
         health_status["status"] = "unhealthy"
     
-    return health_status
+    return Response(
+        content=json_encoder.encode(HealthResponseFast(**health_status)),
+        media_type="application/json"
+    )
+
+
+def _is_json_request(request: Request) -> bool:
+    """Whether FastAPI would parse this request body as JSON (strict content type)"""
+    content_type = request.headers.get("content-type")
+    if not content_type:
+        return False
+    media_type = content_type.split(";")[0].strip().lower()
+    return media_type.startswith("application/") and (
+        media_type == "application/json" or media_type.endswith("+json")
+    )
+
+
+def _validate_login_body(request: Request, body: bytes) -> LoginRequest:
+    """Validate a login body the way a LoginRequest body parameter would
+
+    Only reached when the msgspec fast path can't take the body, so errors
+    carry the same 422 detail FastAPI produces for its own body validation.
+    """
+    data = None
+    if body:
+        if _is_json_request(request):
+            try:
+                data = json.loads(body)
+            except json.JSONDecodeError as e:
+                raise RequestValidationError(
+                    [{
+                        "type": "json_invalid",
+                        "loc": ("body", e.pos),
+                        "msg": "JSON decode error",
+                        "input": {},
+                        "ctx": {"error": e.msg}
+                    }],
+                    body=e.doc
+                )
+        else:
+            data = body
+    if data is None:
+        raise RequestValidationError(
+            [{"type": "missing", "loc": ("body",), "msg": "Field required", "input": None}],
+            body=None
+        )
+    try:
+        return LoginRequest.model_validate(data, from_attributes=True)
+    except ValidationError as e:
+        raise RequestValidationError(
+            [{**error, "loc": ("body", *error["loc"])} for error in e.errors(include_url=False)],
+            body=data
+        )
 
 
 # Authentication Endpoints
-@app.post("/login", response_model=Token)
-async def login(login_data: LoginRequest, db: Session = Depends(get_db)):
+@app.post(
+    "/login",
+    response_model=Token,
+    openapi_extra={
+        "requestBody": {
+            "required": True,
+            "content": {"application/json": {"schema": LoginRequest.model_json_schema()}}
+        }
+    }
+)
+async def login(request: Request, db: Session = Depends(get_db)):
     """User login endpoint"""
+    # Decode the body with msgspec instead of Pydantic (hot, plain payload)
+    body = await request.body()
+    login_data = None
+    if _is_json_request(request):
+        try:
+            login_data = login_request_decoder.decode(body)
+        except msgspec.DecodeError:
+            pass
+    if login_data is None:
+        # Cold path: re-validate with Pydantic so clients get FastAPI's usual 422 body
+        login_data = _validate_login_body(request, body)
+    
     user = db.query(User).filter(User.username == login_data.username).first()
     
-    if not user or not user.verify_password(login_data.password):
+    # bcrypt is CPU-bound; keep it off the event loop
+    if not user or not await run_in_threadpool(user.verify_password, login_data.password):
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Incorrect username or password",
@@ -98,24 +196,28 @@ async def login(login_data: LoginRequest, db: Session = Depends(get_db)):
         data={"sub": user.username}, expires_delta=access_token_expires
     )
     
-    return {"access_token": access_token, "token_type": "bearer"}
+    return Response(
+        content=json_encoder.encode(TokenFast(access_token=access_token)),
+        media_type="application/json"
+    )
 
 
 # User CRUD Endpoints
 @app.post("/users", response_model=UserResponse, status_code=status.HTTP_201_CREATED)
 async def create_user(user: UserCreate, db: Session = Depends(get_db)):
     """Create a new user"""
-    # Check if username exists
-    db_user = db.query(User).filter(User.username == user.username).first()
-    if db_user:
-        raise HTTPException(
-            status_code=status.HTTP_400_BAD_REQUEST,
-            detail="Username already registered"
-        )
-    
-    # Check if email exists
-    db_user = db.query(User).filter(User.email == user.email).first()
-    if db_user:
+    # Check if username or email exists
+    # At most two rows match (both columns are unique); report a username
+    # conflict first, as the separate checks did
+    db_users = db.query(User.username, User.email).filter(
+        or_(User.username == user.username, User.email == user.email)
+    ).all()
+    if db_users:
+        if any(db_user.username == user.username for db_user in db_users):
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail="Username already registered"
+            )
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail="Email already registered"
@@ -125,7 +227,7 @@ async def create_user(user: UserCreate, db: Session = Depends(get_db)):
         username=user.username,
         email=user.email
     )
-    new_user.set_password(user.password)
+    await run_in_threadpool(new_user.set_password, user.password)
     
     db.add(new_user)
     db.commit()
@@ -142,8 +244,13 @@ async def get_users(
     current_user: User = Depends(get_current_active_user)
 ):
     """Get all users (requires authentication)"""
-    users = db.query(User).offset(skip).limit(limit).all()
-    return users
+    users = db.execute(
+        select(*USER_RESPONSE_COLUMNS).offset(skip).limit(limit)
+    ).mappings().all()
+    return Response(
+        content=UserListAdapter.dump_json(UserListAdapter.validate_python(users)),
+        media_type="application/json"
+    )
 
 
 @app.get("/users/me", response_model=UserResponse)
@@ -207,23 +314,33 @@ async def update_user(
         )
     
     # Check if new username/email already exists
-    if user_update.username and user_update.username != user.username:
-        existing_user = db.query(User).filter(User.username == user_update.username).first()
-        if existing_user:
-            raise HTTPException(
-                status_code=status.HTTP_400_BAD_REQUEST,
-                detail="Username already taken"
-            )
-        user.username = user_update.username
-    
-    if user_update.email and user_update.email != user.email:
-        existing_user = db.query(User).filter(User.email == user_update.email).first()
-        if existing_user:
+    new_username = user_update.username if user_update.username and user_update.username != user.username else None
+    new_email = user_update.email if user_update.email and user_update.email != user.email else None
+    
+    conflicts = []
+    if new_username:
+        conflicts.append(User.username == new_username)
+    if new_email:
+        conflicts.append(User.email == new_email)
+    
+    if conflicts:
+        existing_users = db.query(User.username, User.email).filter(or_(*conflicts)).all()
+        if existing_users:
+            if new_username and any(existing.username == new_username for existing in existing_users):
+                raise HTTPException(
+                    status_code=status.HTTP_400_BAD_REQUEST,
+                    detail="Username already taken"
+                )
             raise HTTPException(
                 status_code=status.HTTP_400_BAD_REQUEST,
                 detail="Email already taken"
             )
-        user.email = user_update.email
+    
+    if new_username:
+        user.username = new_username
+    
+    if new_email:
+        user.email = new_email
     
     if user_update.push_token is not None:
         user.push_token = user_update.push_token
@@ -234,6 +351,9 @@ async def update_user(
     db.commit()
     db.refresh(user)
     
+    # Invalidate cache
+    await invalidate_user_cache(str(user_id))
+    
     return user
 
 
@@ -259,7 +379,8 @@ async def delete_user(
         )
     
     # Invalidate cache
-    invalidate_preferences_cache(str(user_id))
+    await invalidate_preferences_cache(str(user_id))
+    await invalidate_user_cache(str(user_id))
     
     db.delete(user)
     db.commit()
@@ -276,15 +397,8 @@ async def create_preference(
     current_user: User = Depends(get_current_active_user)
 ):
     """Create notification preference for a user"""
-    # Verify user exists
-    user = db.query(User).filter(User.id == user_id).first()
-    if not user:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail="User not found"
-        )
-    
-    # Users can only create preferences for themselves
+    # Users can only create preferences for themselves (current_user is
+    # already loaded, so this also proves the user exists)
     if current_user.id != user_id:
         raise HTTPException(
             status_code=status.HTTP_403_FORBIDDEN,
@@ -316,7 +430,7 @@ async def create_preference(
     db.refresh(new_preference)
     
     # Invalidate cache
-    invalidate_preferences_cache(str(user_id))
+    await invalidate_preferences_cache(str(user_id))
     
     return new_preference
 
@@ -328,43 +442,30 @@ async def get_preferences(
     current_user: User = Depends(get_current_active_user)
 ):
     """Get all notification preferences for a user"""
-    # Verify user exists
-    user = db.query(User).filter(User.id == user_id).first()
-    if not user:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail="User not found"
-        )
-    
-    # Users can only view their own preferences
+    # Users can only view their own preferences (current_user is already
+    # loaded, so this also proves the user exists)
     if current_user.id != user_id:
         raise HTTPException(
             status_code=status.HTTP_403_FORBIDDEN,
             detail="Not enough permissions"
         )
     
+    # Serve the already-serialized payload on a cache hit
+    cached, lock_token = await get_or_lock_preferences_raw(str(user_id))
+    if cached:
+        return Response(content=cached, media_type="application/json")
+    
     # Get from database
     preferences = db.query(NotificationPreference).filter(
         NotificationPreference.user_id == user_id
     ).all()
     
-    # Cache the preferences as a list of dicts
-    preferences_list = []
-    for pref in preferences:
-        pref_dict = {
-            "id": pref.id,
-            "user_id": pref.user_id,
-            "notification_type": pref.notification_type,
-            "channel": pref.channel,
-            "enabled": pref.enabled,
-            "created_at": pref.created_at.isoformat() if pref.created_at else None,
-            "updated_at": pref.updated_at.isoformat() if pref.updated_at else None
-        }
-        preferences_list.append(pref_dict)
-    
-    cache_user_preferences(str(user_id), preferences_list)
+    # Serialize once; the same bytes are cached (by the lock holder) and returned
+    payload = PreferenceListAdapter.dump_json(PreferenceListAdapter.validate_python(preferences))
+    if lock_token:
+        await cache_user_preferences_raw(str(user_id), payload, lock_token=lock_token)
     
-    return preferences
+    return Response(content=payload, media_type="application/json")
 
 
 @app.get("/users/{user_id}/preferences/{preference_id}", response_model=NotificationPreferenceResponse)
@@ -430,7 +531,7 @@ async def update_preference(
     db.refresh(preference)
     
     # Invalidate cache
-    invalidate_preferences_cache(str(user_id))
+    await invalidate_preferences_cache(str(user_id))
     
     return preference
 
@@ -465,7 +566,7 @@ async def delete_preference(
     db.commit()
     
     # Invalidate cache
-    invalidate_preferences_cache(str(user_id))
+    await invalidate_preferences_cache(str(user_id))
     
     return None
 
@@ -473,40 +574,45 @@ async def delete_preference(
 # Additional endpoint for API Gateway to get user info by ID (no auth required for gateway)
 @app.get("/internal/users/{user_id}", response_model=UserResponse)
 async def get_user_internal(user_id: int, db: Session = Depends(get_db)):
-    """Internal endpoint for API Gateway to get user info"""
-    user = db.query(User).filter(User.id == user_id).first()
+    """Internal endpoint for API Gateway to get user info (with caching)"""
+    cached = await get_cached_user_raw(str(user_id))
+    if cached:
+        return Response(content=cached, media_type="application/json")
+    
+    user = db.execute(
+        select(*USER_RESPONSE_COLUMNS).where(User.id == user_id)
+    ).mappings().first()
     if not user:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail="User not found"
         )
-    return user
+    
+    user_dict = UserResponse.model_validate(dict(user)).model_dump(mode="json")
+    await cache_user(str(user_id), user_dict)
+    
+    # Already validated above; skip response_model re-validation
+    return ORJSONResponse(content=user_dict)
 
 
 # Endpoint for API Gateway to get cached preferences
 @app.get("/internal/users/{user_id}/preferences", response_model=List[NotificationPreferenceResponse])
 async def get_preferences_internal(user_id: int, db: Session = Depends(get_db)):
     """Internal endpoint for API Gateway to get user preferences (with caching)"""
-    # Get from database
-    preferences = db.query(NotificationPreference).filter(
-        NotificationPreference.user_id == user_id
-    ).all()
+    # Serve the already-serialized payload on a cache hit
+    cached, lock_token = await get_or_lock_preferences_raw(str(user_id))
+    if cached:
+        return Response(content=cached, media_type="application/json")
     
-    # Cache the preferences as a list of dicts
-    preferences_list = []
-    for pref in preferences:
-        pref_dict = {
-            "id": pref.id,
-            "user_id": pref.user_id,
-            "notification_type": pref.notification_type,
-            "channel": pref.channel,
-            "enabled": pref.enabled,
-            "created_at": pref.created_at.isoformat() if pref.created_at else None,
-            "updated_at": pref.updated_at.isoformat() if pref.updated_at else None
-        }
-        preferences_list.append(pref_dict)
+    # Get from database
+    preferences = db.execute(
+        select(*PREFERENCE_RESPONSE_COLUMNS).where(NotificationPreference.user_id == user_id)
+    ).mappings().all()
     
-    cache_user_preferences(str(user_id), preferences_list)
+    # Serialize once; the same bytes are cached (by the lock holder) and returned
+    payload = PreferenceListAdapter.dump_json(PreferenceListAdapter.validate_python(preferences))
+    if lock_token:
+        await cache_user_preferences_raw(str(user_id), payload, lock_token=lock_token)
     
-    return preferences
+    return Response(content=payload, media_type="application/json")
 
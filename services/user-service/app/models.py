@@ -1,6 +1,7 @@
-from sqlalchemy import Column, Integer, String, Boolean, DateTime, ForeignKey, Text
+from sqlalchemy import Column, Integer, String, Boolean, DateTime, ForeignKey, Text, UniqueConstraint
 from sqlalchemy.orm import relationship
 from sqlalchemy.sql import func
+from app.config import settings
 from app.database import Base
 import bcrypt
 
@@ -30,7 +31,7 @@ class User(Base):
 
     def set_password(self, password: str):
         """Hash and set password"""
-        hashed = bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt())
+        hashed = bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt(rounds=settings.bcrypt_rounds))
         self.hashed_password = hashed.decode('utf-8')
 
 
@@ -48,6 +49,6 @@ class NotificationPreference(Base):
     user = relationship("User", back_populates="notification_preferences")
 
     __table_args__ = (
-        {'unique_constraint': ('user_id', 'notification_type', 'channel')},
+        UniqueConstraint('user_id', 'notification_type', 'channel', name='uq_user_type_channel'),
     )
 
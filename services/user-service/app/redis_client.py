@@ -1,45 +1,235 @@
-import redis
+from redis.asyncio import Redis, ConnectionPool
 from app.config import settings
-from typing import Optional
-import json
+from cachetools import TTLCache
+from typing import Optional, Tuple
+import secrets
+import threading
+import zstandard as zstd
 
-redis_client: Optional[redis.Redis] = None
+# orjson is much faster than stdlib json; fall back to msgspec's C codec
+# (near-orjson speed) and only then to stdlib json
+try:
+    import orjson
+    _dumps = orjson.dumps
+    _loads = orjson.loads
+except ImportError:
+    try:
+        import msgspec
+        _json_encoder = msgspec.json.Encoder()
+        _json_decoder = msgspec.json.Decoder()
+        _dumps = _json_encoder.encode
+        _loads = _json_decoder.decode
+    except ImportError:
+        import json
+
+        def _dumps(value) -> bytes:
+            return json.dumps(value).encode()
+
+        _loads = json.loads
+
+# Preference payloads are stored behind a 1-byte flag; larger ones are
+# zstd-compressed. Entries written before the flag existed start with '['.
+_FLAG_PLAIN = b"\x00"
+_FLAG_ZSTD = b"\x01"
+_COMPRESS_MIN_SIZE = 256
+_compressor = zstd.ZstdCompressor(level=3)
+_decompressor = zstd.ZstdDecompressor()
+
+
+def _pack(payload: bytes) -> bytes:
+    if len(payload) < _COMPRESS_MIN_SIZE:
+        return _FLAG_PLAIN + payload
+    return _FLAG_ZSTD + _compressor.compress(payload)
+
+
+def _unpack(stored: bytes) -> bytes:
+    flag = stored[:1]
+    if flag == _FLAG_ZSTD:
+        return _decompressor.decompress(stored[1:])
+    if flag == _FLAG_PLAIN:
+        return stored[1:]
+    return stored
+
+# Bounded pool shared by every client so concurrent requests reuse warm sockets
+redis_pool = ConnectionPool(
+    host=settings.redis_host,
+    port=settings.redis_port,
+    db=settings.redis_db,
+    password=settings.redis_password,
+    max_connections=settings.redis_pool_size,
+    health_check_interval=30
+)
+
+
+_PREFERENCES_KEY_PREFIX = b"user_preferences:"
+_PREFERENCES_LOCK_KEY_PREFIX = b"user_preferences_lock:"
+_USER_KEY_PREFIX = b"user:"
+
+
+def _key(prefix: bytes, user_id) -> bytes:
+    return prefix + (user_id if isinstance(user_id, bytes) else str(user_id).encode())
+
+
+# In-process cache of raw payloads in front of Redis. Only bytes are kept so
+# callers always get a fresh decode they're free to mutate. Entries may lag
+# other workers' writes by up to cache_local_ttl seconds.
+_local_preferences = TTLCache(maxsize=settings.cache_local_maxsize, ttl=settings.cache_local_ttl)
+_local_lock = threading.Lock()
+
+
+def _local_get(user_id: str):
+    with _local_lock:
+        return _local_preferences.get(user_id)
+
+
+def _local_set(user_id: str, payload: bytes):
+    with _local_lock:
+        _local_preferences[user_id] = payload
+
+
+def _local_pop(*user_ids: str):
+    with _local_lock:
+        for user_id in user_ids:
+            _local_preferences.pop(user_id, None)
 
 
 def get_redis():
     """Get Redis client instance"""
-    global redis_client
-    if redis_client is None:
-        redis_client = redis.Redis(
-            host=settings.redis_host,
-            port=settings.redis_port,
-            db=settings.redis_db,
-            password=settings.redis_password,
-            decode_responses=True
-        )
-    return redis_client
+    return Redis(connection_pool=redis_pool)
+
 
+# Read-through in one RTT: return the cached value, or try to take the
+# recompute lock under the caller's token (1 = acquired, 0 = someone else
+# is recomputing)
+_get_or_lock = get_redis().register_script("""
+local v = redis.call('GET', KEYS[1])
+if v then return v end
+if redis.call('SET', KEYS[2], ARGV[2], 'EX', ARGV[1], 'NX') then return 1 end
+return 0
+""")
 
-def cache_user_preferences(user_id: str, preferences: dict, ttl: int = 3600):
+# Write the recomputed value only if the caller still holds the lock; an
+# invalidation in between clears the lock, so a stale payload is dropped
+_set_if_locked = get_redis().register_script("""
+if redis.call('GET', KEYS[2]) ~= ARGV[1] then return 0 end
+redis.call('SET', KEYS[1], ARGV[2], 'EX', ARGV[3])
+redis.call('UNLINK', KEYS[2])
+return 1
+""")
+
+
+async def cache_user_preferences(user_id: str, preferences: dict, ttl: int = 3600):
     """Cache user notification preferences"""
-    redis = get_redis()
-    key = f"user_preferences:{user_id}"
-    redis.setex(key, ttl, json.dumps(preferences))
+    await cache_user_preferences_raw(user_id, _dumps(preferences), ttl)
 
 
-def get_cached_preferences(user_id: str) -> Optional[dict]:
+async def cache_user_preferences_raw(user_id: str, payload: bytes, ttl: int = 3600,
+                                     lock_token: Optional[str] = None):
+    """Cache an already-serialized preferences JSON payload
+
+    With a lock_token from get_or_lock_preferences_raw, the payload is only
+    written while that lock is still held.
+    """
+    # Stored as JSON (not msgpack) on purpose: preference endpoints return
+    # this payload verbatim on a cache hit, so it must already be the
+    # response body.
+    if lock_token is not None:
+        written = await _set_if_locked(
+            keys=[_key(_PREFERENCES_KEY_PREFIX, user_id), _key(_PREFERENCES_LOCK_KEY_PREFIX, user_id)],
+            args=[lock_token, _pack(payload), ttl]
+        )
+        if written:
+            _local_set(user_id, payload)
+        return
+    pipe = get_redis().pipeline(transaction=False)
+    pipe.set(_key(_PREFERENCES_KEY_PREFIX, user_id), _pack(payload), ex=ttl)
+    pipe.unlink(_key(_PREFERENCES_LOCK_KEY_PREFIX, user_id))
+    await pipe.execute()
+    _local_set(user_id, payload)
+
+
+async def get_cached_preferences(user_id: str) -> Optional[dict]:
     """Get cached user notification preferences"""
-    redis = get_redis()
-    key = f"user_preferences:{user_id}"
-    cached = redis.get(key)
+    cached = await get_cached_preferences_raw(user_id)
     if cached:
-        return json.loads(cached)
+        return _loads(cached)
     return None
 
 
-def invalidate_preferences_cache(user_id: str):
+async def get_cached_preferences_raw(user_id: str) -> Optional[bytes]:
+    """Get cached user notification preferences as the stored JSON payload"""
+    cached = _local_get(user_id)
+    if cached is not None:
+        return cached
+    redis = get_redis()
+    key = _key(_PREFERENCES_KEY_PREFIX, user_id)
+    cached = await redis.get(key)
+    if cached:
+        cached = _unpack(cached)
+        _local_set(user_id, cached)
+    return cached
+
+
+async def get_or_lock_preferences_raw(user_id: str, lock_ttl: int = 5) -> Tuple[Optional[bytes], Optional[str]]:
+    """Get the cached payload, or (None, lock_token) if the caller should recompute it
+
+    Pass the token to cache_user_preferences_raw when writing the result.
+    (None, None) means another request holds the lock; the caller can
+    still answer from the database but should not write the cache.
+    """
+    payload = _local_get(user_id)
+    if payload is not None:
+        return payload, None
+    lock_token = secrets.token_hex(8)
+    result = await _get_or_lock(
+        keys=[_key(_PREFERENCES_KEY_PREFIX, user_id), _key(_PREFERENCES_LOCK_KEY_PREFIX, user_id)],
+        args=[lock_ttl, lock_token]
+    )
+    if isinstance(result, bytes):
+        payload = _unpack(result)
+        _local_set(user_id, payload)
+        return payload, None
+    return None, lock_token if result == 1 else None
+
+
+async def invalidate_preferences_cache(user_id: str):
     """Invalidate cached user preferences"""
+    # Clearing the lock as well stops an in-flight recompute, which may have
+    # read the rows before this change, from caching its stale payload
     redis = get_redis()
-    key = f"user_preferences:{user_id}"
-    redis.delete(key)
+    await redis.unlink(
+        _key(_PREFERENCES_KEY_PREFIX, user_id),
+        _key(_PREFERENCES_LOCK_KEY_PREFIX, user_id)
+    )
+    _local_pop(user_id)
+
 
+async def cache_user(user_id: str, user: dict, ttl: int = 300):
+    """Cache user info served to internal callers"""
+    redis = get_redis()
+    key = _key(_USER_KEY_PREFIX, user_id)
+    await redis.setex(key, ttl, _dumps(user))
+
+
+async def get_cached_user(user_id: str) -> Optional[dict]:
+    """Get cached user info"""
+    redis = get_redis()
+    key = _key(_USER_KEY_PREFIX, user_id)
+    cached = await redis.get(key)
+    if cached:
+        return _loads(cached)
+    return None
+
+
+async def get_cached_user_raw(user_id: str) -> Optional[bytes]:
+    """Get cached user info as the stored JSON payload"""
+    redis = get_redis()
+    key = _key(_USER_KEY_PREFIX, user_id)
+    return await redis.get(key)
+
+
+async def invalidate_user_cache(user_id: str):
+    """Invalidate cached user info"""
+    redis = get_redis()
+    key = _key(_USER_KEY_PREFIX, user_id)
+    await redis.unlink(key)
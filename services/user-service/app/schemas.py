@@ -1,12 +1,28 @@
-from pydantic import BaseModel, EmailStr, Field
-from typing import Optional, List
+from pydantic import AfterValidator, BaseModel, ConfigDict, Field, TypeAdapter, WithJsonSchema
+from email_validator import validate_email
+from functools import lru_cache
+from typing import Annotated, Optional, List
 from datetime import datetime
 
 
+@lru_cache(maxsize=10_000)
+def _valid_email(value: str) -> str:
+    """Validate and normalize an email address (syntax only, no DNS)"""
+    return validate_email(value, check_deliverability=False).normalized
+
+
+# Same behaviour as pydantic's EmailStr, but repeat addresses hit the LRU
+Email = Annotated[
+    str,
+    AfterValidator(_valid_email),
+    WithJsonSchema({"type": "string", "format": "email"})
+]
+
+
 # User Schemas
 class UserBase(BaseModel):
     username: str = Field(..., min_length=3, max_length=100)
-    email: EmailStr
+    email: Email
 
 
 class UserCreate(UserBase):
@@ -15,7 +31,7 @@ class UserCreate(UserBase):
 
 class UserUpdate(BaseModel):
     username: Optional[str] = Field(None, min_length=3, max_length=100)
-    email: Optional[EmailStr] = None
+    email: Optional[Email] = None
     push_token: Optional[str] = None
     is_active: Optional[bool] = None
 
@@ -27,8 +43,7 @@ class UserResponse(UserBase):
     created_at: datetime
     updated_at: Optional[datetime] = None
 
-    class Config:
-        from_attributes = True
+    model_config = ConfigDict(from_attributes=True, frozen=True)
 
 
 # Notification Preference Schemas
@@ -52,8 +67,12 @@ class NotificationPreferenceResponse(NotificationPreferenceBase):
     created_at: datetime
     updated_at: Optional[datetime] = None
 
-    class Config:
-        from_attributes = True
+    model_config = ConfigDict(from_attributes=True, frozen=True)
+
+
+# Compiled once; validate/serialize whole lists in a single call
+UserListAdapter = TypeAdapter(List[UserResponse])
+PreferenceListAdapter = TypeAdapter(List[NotificationPreferenceResponse])
 
 
 # Auth Schemas
@@ -78,3 +97,5 @@ class HealthResponse(BaseModel):
     database: str
     redis: str
 
+    model_config = ConfigDict(frozen=True)
+
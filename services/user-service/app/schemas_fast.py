@@ -0,0 +1,28 @@
+import msgspec
+
+
+# msgspec counterparts of hot request schemas, decoded straight from the raw
+# body. Only plain structs live here; anything needing EmailStr-style
+# validation stays a Pydantic model in app.schemas.
+class LoginRequestFast(msgspec.Struct):
+    username: str
+    password: str
+
+
+login_request_decoder = msgspec.json.Decoder(LoginRequestFast)
+
+
+# Response DTOs that need no validation; encoded directly by msgspec
+class TokenFast(msgspec.Struct, frozen=True):
+    access_token: str
+    token_type: str = "bearer"
+
+
+class HealthResponseFast(msgspec.Struct, frozen=True):
+    status: str
+    service: str
+    database: str
+    redis: str
+
+
+json_encoder = msgspec.json.Encoder()